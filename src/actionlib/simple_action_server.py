@@ -31,14 +31,36 @@
 
 import rospy
 
+import copy
+import logging
 import threading
 import traceback
 
+try:
+    from sys import intern  # Python 3
+except ImportError:
+    pass  # Python 2 builtin
+
 from actionlib_msgs.msg import *
+from actionlib_msgs.msg import GoalStatus
 
 from actionlib import ActionServer
 from actionlib.server_goal_handle import ServerGoalHandle;
 
+# cached at module level so the status checks on the per-goal hot path
+# resolve with a single global lookup instead of three dotted lookups
+_ACTIVE = GoalStatus.ACTIVE
+_PREEMPTING = GoalStatus.PREEMPTING
+
+# rospy logs through the 'rosout' logger; the hot-path debug statements
+# below check this logger first so the log call (and its argument
+# evaluation) is skipped entirely when debug logging is off
+_logger = logging.getLogger('rosout')
+
+_NO_TERMINAL_STATE_WARNING = ("Your executeCallback did not set the goal to a terminal status.  "
+                              "This is a bug in your ActionServer implementation. Fix your code!  "
+                              "For now, the ActionServer will set this goal to aborted")
+
 def nop_cb(goal_handle):
     pass
 
@@ -70,37 +92,75 @@ class SimpleActionServer:
         self.goal_callback = None;
         self.preempt_callback = None;
 
+        # need_to_terminate is guarded by self.lock below
         self.need_to_terminate = False
-        self.terminate_mutex = threading.RLock();
 
         # since the internal_goal/preempt_callbacks are invoked from the
         # ActionServer while holding the self.action_server.lock
         # self.lock must always be locked after the action server lock
         # to avoid an inconsistent lock acquisition order
+        # self.lock has to stay recursive: user goal/preempt callbacks are
+        # invoked while it is held and legitimately re-enter methods like
+        # accept_new_goal() and set_preempted() that acquire it again
         self.lock = threading.RLock();
 
-        self.execute_condition = threading.Condition(self.lock);
+        # signals executeLoop that a new goal has arrived or that the
+        # server is terminating; the event stays set until the loop
+        # clears it, so a wakeup sent while the execute callback is
+        # still running is never lost
+        self._goal_event = threading.Event();
 
         self.current_goal = ServerGoalHandle();
         self.next_goal = ServerGoalHandle();
 
+        # goal stamps packed as integer nanoseconds, kept in sync with
+        # every assignment of current_goal/next_goal; -1 means the handle
+        # carries no goal and any incoming stamp supersedes it
+        self._current_stamp_ns = -1
+        self._next_stamp_ns = -1
+
+        # interned goal id strings, kept in sync the same way (None when
+        # the handle carries no goal); interning makes the preempt
+        # matching below an identity check instead of a string compare
+        self._current_goal_id = None
+        self._next_goal_id = None
+
+        # False until a goal is accepted and after a terminal transition,
+        # so is_active() can skip the status lookup entirely
+        self._has_current = False
+
+        # the execute thread is started lazily by internal_goal_callback
+        # when the first goal arrives, so idle servers do not hold a
+        # thread (and its stack) from construction onwards
+        self.execute_thread = None
         if self.execute_callback:
-            self.execute_thread = threading.Thread(None, self.executeLoop);
-            self.execute_thread.start();
-        else:
-            self.execute_thread = None
+            # executeLoop blocks on the goal event without a timeout,
+            # so it has to be woken up explicitly on shutdown
+            rospy.on_shutdown(self._shutdown_notify);
 
         #create the action server
         self.action_server = ActionServer(name, ActionSpec, self.internal_goal_callback,self.internal_preempt_callback,auto_start);
 
+        # template for get_default_result, cloned instead of running the
+        # message constructor for every terminal transition
+        self._default_result = self.action_server.ActionResultType();
+
 
     def __del__(self):
         if hasattr(self, 'execute_callback') and self.execute_callback:
-            with self.terminate_mutex:
-                self.need_to_terminate = True;
+            self._shutdown_notify();
+
+            if self.execute_thread:
+                # bounded join: the loop normally exits right after the
+                # notify above, and __del__ must never block indefinitely
+                # (it may run during interpreter shutdown)
+                self.execute_thread.join(timeout=0.2);
 
-            assert(self.execute_thread);
-            self.execute_thread.join();
+    ## @brief Wakes up executeLoop so it can notice need_to_terminate
+    def _shutdown_notify(self):
+        with self.lock:
+            self.need_to_terminate = True;
+            self._goal_event.set();
 
 
     ## @brief Accepts a new goal when one is available The status of this
@@ -114,18 +174,23 @@ class SimpleActionServer:
     ## @return A shared_ptr to the new goal.
     def accept_new_goal(self):
         with self.action_server.lock, self.lock:
-            if not self.new_goal or not self.next_goal.get_goal():
+            next_goal = self.next_goal;
+            if not self.new_goal or not next_goal.get_goal():
                 rospy.logerr("Attempting to accept the next goal when a new goal is not available");
                 return None;
 
             #check if we need to send a preempted message for the goal that we're currently pursuing
-            if self.is_active() and self.current_goal.get_goal() and self.current_goal != self.next_goal:
-                self.current_goal.set_canceled(None, "This goal was canceled because another goal was received by the simple action server");
+            current_goal = self.current_goal;
+            if self.is_active() and current_goal.get_goal() and current_goal != next_goal:
+                current_goal.set_canceled(None, "This goal was canceled because another goal was received by the simple action server");
 
             rospy.logdebug("Accepting a new goal");
 
             #accept the next goal
-            self.current_goal = self.next_goal;
+            self.current_goal = next_goal;
+            self._current_stamp_ns = self._next_stamp_ns;
+            self._current_goal_id = self._next_goal_id;
+            self._has_current = True;
             self.new_goal = False;
 
             #set preempt to request to equal the preempt state of the new goal
@@ -133,9 +198,9 @@ class SimpleActionServer:
             self.new_goal_preempt_request = False;
 
             #set the status of the current goal to be active
-            self.current_goal.set_accepted("This goal has been accepted by the simple action server");
+            next_goal.set_accepted("This goal has been accepted by the simple action server");
 
-            return self.current_goal.get_goal();
+            return next_goal.get_goal();
 
 
     ## @brief Allows  polling implementations to query about the availability of a new goal
@@ -152,11 +217,13 @@ class SimpleActionServer:
     ## @brief Allows  polling implementations to query about the status of the current goal
     ## @return True if a goal is active, false otherwise
     def is_active(self):
+       if not self._has_current:
+           return False;
        if not self.current_goal.get_goal():
            return False;
 
        status = self.current_goal.get_goal_status().status;
-       return status == actionlib_msgs.msg.GoalStatus.ACTIVE or status == actionlib_msgs.msg.GoalStatus.PREEMPTING;
+       return status == _ACTIVE or status == _PREEMPTING;
 
     ## @brief Sets the status of the active goal to succeeded
     ## @param  result An optional result to send back to any clients of the goal
@@ -165,6 +232,7 @@ class SimpleActionServer:
           if not result:
               result=self.get_default_result();
           self.current_goal.set_succeeded(result, text);
+          self._has_current = False;
 
     ## @brief Sets the status of the active goal to aborted
     ## @param  result An optional result to send back to any clients of the goal
@@ -173,24 +241,34 @@ class SimpleActionServer:
             if not result:
                 result=self.get_default_result();
             self.current_goal.set_aborted(result, text);
+            self._has_current = False;
 
     ## @brief Publishes feedback for a given goal
     ## @param  feedback Shared pointer to the feedback to publish
     def publish_feedback(self,feedback):
-        self.current_goal.publish_feedback(feedback);
+        # snapshot the handle under the lock so we do not race with
+        # accept_new_goal swapping current_goal, but publish outside it:
+        # publish_feedback acquires the action server lock, which must
+        # never be taken while self.lock is held
+        with self.lock:
+            current_goal = self.current_goal;
+        current_goal.publish_feedback(feedback);
 
 
     def get_default_result(self):
-        return self.action_server.ActionResultType();
+        # a shallow copy skips the field-defaulting work in the message
+        # constructor; callers get their own top-level message to fill in
+        return copy.copy(self._default_result);
 
     ## @brief Sets the status of the active goal to preempted
     ## @param  result An optional result to send back to any clients of the goal
     def set_preempted(self,result=None, text=""):
-        if not result:
-            result=self.get_default_result();
         with self.action_server.lock, self.lock:
+            if not result:
+                result=self.get_default_result();
             rospy.logdebug("Setting the current goal as canceled");
             self.current_goal.set_canceled(result, text);
+            self._has_current = False;
 
     ## @brief Allows users to register a callback to be invoked when a new goal is available
     ## @param cb The callback to be invoked
@@ -213,82 +291,117 @@ class SimpleActionServer:
 
     ## @brief Callback for when the ActionServer receives a new goal and passes it on
     def internal_goal_callback(self, goal):
-          self.execute_condition.acquire();
-
-          try:
-              rospy.logdebug("A new goal %shas been recieved by the single goal action server",goal.get_goal_id().id);
-
-              #check that the timestamp is past that of the current goal and the next goal
-              if((not self.current_goal.get_goal() or goal.get_goal_id().stamp >= self.current_goal.get_goal_id().stamp)
-                 and (not self.next_goal.get_goal() or goal.get_goal_id().stamp >= self.next_goal.get_goal_id().stamp)):
-                  #if next_goal has not been accepted already... its going to get bumped, but we need to let the client know we're preempting
-                  if(self.next_goal.get_goal() and (not self.current_goal.get_goal() or self.next_goal != self.current_goal)):
-                      self.next_goal.set_canceled(None, "This goal was canceled because another goal was received by the simple action server");
-
-                  self.next_goal = goal;
-                  self.new_goal = True;
-                  self.new_goal_preempt_request = False;
-
-                  #if the server is active, we'll want to call the preempt callback for the current goal
-                  if(self.is_active()):
-                      self.preempt_request = True;
-                      #if the user has registered a preempt callback, we'll call it now
-                      if(self.preempt_callback):
-                          self.preempt_callback();
-
-                  #if the user has defined a goal callback, we'll call it now
-                  if self.goal_callback:
-                      self.goal_callback();
-
-                  #Trigger runLoop to call execute()
-                  self.execute_condition.notify();
-                  self.execute_condition.release();
-              else:
-                  #the goal requested has already been preempted by a different goal, so we're not going to execute it
-                  goal.set_canceled(None, "This goal was canceled because another goal was received by the simple action server");
-                  self.execute_condition.release();
-          except Exception, e:
-              rospy.logerr("SimpleActionServer.internal_goal_callback - exception %s",str(e))
-              self.execute_condition.release();
+          with self.lock:
+              try:
+                  goal_id = goal.get_goal_id();
+                  if _logger.isEnabledFor(logging.DEBUG):
+                      rospy.logdebug("A new goal %shas been recieved by the single goal action server",goal_id.id);
+
+                  #bind the goal handles and the incoming stamp to locals, they are
+                  #needed several times below
+                  current_goal = self.current_goal;
+                  next_goal = self.next_goal;
+                  has_current_goal = current_goal.get_goal() is not None;
+                  has_next_goal = next_goal.get_goal() is not None;
+                  goal_stamp_ns = goal_id.stamp.to_nsec();
+
+                  #check that the timestamp is past that of the current goal and the next goal
+                  if(self._should_accept(goal_stamp_ns)):
+                      #if next_goal has not been accepted already... its going to get bumped, but we need to let the client know we're preempting
+                      if(has_next_goal and (not has_current_goal or next_goal != current_goal)):
+                          next_goal.set_canceled(None, "This goal was canceled because another goal was received by the simple action server");
+
+                      self.next_goal = goal;
+                      self._next_stamp_ns = goal_stamp_ns;
+                      self._next_goal_id = intern(goal_id.id);
+                      self.new_goal = True;
+                      self.new_goal_preempt_request = False;
+
+                      #if the server is active, we'll want to call the preempt callback for the current goal
+                      if(self.is_active()):
+                          self.preempt_request = True;
+                          #if the user has registered a preempt callback, we'll call it now
+                          preempt_callback = self.preempt_callback;
+                          if(preempt_callback):
+                              preempt_callback();
+
+                      #if the user has defined a goal callback, we'll call it now
+                      goal_callback = self.goal_callback;
+                      if goal_callback:
+                          goal_callback();
+
+                      #start the execute thread on the first goal; guarded by
+                      #self.lock, so it can only be created once
+                      if self.execute_callback and self.execute_thread is None:
+                          self.execute_thread = threading.Thread(None, self.executeLoop);
+                          # a daemon thread cannot stall interpreter exit;
+                          # orderly termination still goes through
+                          # need_to_terminate and the goal event
+                          self.execute_thread.daemon = True;
+                          self.execute_thread.start();
+
+                      #Trigger runLoop to call execute()
+                      self._goal_event.set();
+                  else:
+                      #the goal requested has already been preempted by a different goal, so we're not going to execute it
+                      goal.set_canceled(None, "This goal was canceled because another goal was received by the simple action server");
+              except Exception as e:
+                  rospy.logerr("SimpleActionServer.internal_goal_callback - exception %s",str(e))
+
+    ## @brief Checks whether an incoming goal's stamp supersedes both the
+    ## current and the next goal. Compares against the cached
+    ## integer-nanosecond stamps (-1 when a handle carries no goal), so
+    ## this is two plain int comparisons. Must be called with self.lock
+    ## held.
+    def _should_accept(self, goal_stamp_ns):
+        return (goal_stamp_ns >= self._current_stamp_ns
+                and goal_stamp_ns >= self._next_stamp_ns);
 
     ## @brief Callback for when the ActionServer receives a new preempt and passes it on
     def internal_preempt_callback(self,preempt):
           with self.lock:
-              rospy.logdebug("A preempt has been received by the SimpleActionServer");
+              if _logger.isEnabledFor(logging.DEBUG):
+                  rospy.logdebug("A preempt has been received by the SimpleActionServer");
+
+              # both sides are interned, so goal identity reduces to a
+              # pointer comparison; None (no goal) never matches
+              preempt_id = intern(preempt.get_goal_id().id);
 
               #if the preempt is for the current goal, then we'll set the preemptRequest flag and call the user's preempt callback
-              if(preempt == self.current_goal):
+              if(preempt_id is self._current_goal_id):
                   rospy.logdebug("Setting preempt_request bit for the current goal to TRUE and invoking callback");
                   self.preempt_request = True;
 
                   #if the user has registered a preempt callback, we'll call it now
-                  if(self.preempt_callback):
-                      self.preempt_callback();
+                  preempt_callback = self.preempt_callback;
+                  if(preempt_callback):
+                      preempt_callback();
               #if the preempt applies to the next goal, we'll set the preempt bit for that
-              elif(preempt == self.next_goal):
+              elif(preempt_id is self._next_goal_id):
                   rospy.logdebug("Setting preempt request bit for the next goal to TRUE");
                   self.new_goal_preempt_request = True;
 
     ## @brief Called from a separate thread to call blocking execute calls
     def executeLoop(self):
-          loop_duration = rospy.Duration.from_sec(.1);
-
-          while (not rospy.is_shutdown()):
-              rospy.logdebug("SAS: execute");
+          # bind the attributes touched on every iteration to locals once;
+          # this loop runs for the lifetime of the server
+          goal_event = self._goal_event;
+          is_active = self.is_active;
+          is_new_goal_available = self.is_new_goal_available;
 
-              with self.terminate_mutex:
-                  if (self.need_to_terminate):
-                      break;
+          while (not self.need_to_terminate):
+              if _logger.isEnabledFor(logging.DEBUG):
+                  rospy.logdebug("SAS: execute");
 
               # the following checks (is_active, is_new_goal_available)
               # are performed without locking
               # the worst thing that might happen in case of a race
               # condition is a warning/error message on the console
-              if (self.is_active()):
+              if (is_active()):
                   rospy.logerr("Should never reach this code with an active goal");
                   return
 
-              if (self.is_new_goal_available()):
+              if (is_new_goal_available()):
                   # accept_new_goal() is performing its own locking
                   goal = self.accept_new_goal();
                   if not self.execute_callback:
@@ -299,17 +412,19 @@ class SimpleActionServer:
                       self.execute_callback(goal)
 
                       if self.is_active():
-                          rospy.logwarn("Your executeCallback did not set the goal to a terminal status.  " +
-                                        "This is a bug in your ActionServer implementation. Fix your code!  "+
-                                        "For now, the ActionServer will set this goal to aborted");
+                          rospy.logwarn(_NO_TERMINAL_STATE_WARNING);
                           self.set_aborted(None, "No terminal state was set.");
-                  except Exception, ex:
+                  except Exception as ex:
                       rospy.logerr("Exception in your execute callback: %s\n%s", str(ex),
                                    traceback.format_exc())
                       self.set_aborted(None, "Exception in execute callback: %s" % str(ex))
 
-              with self.execute_condition:
-                  self.execute_condition.wait(loop_duration.to_sec());
+              # the event stays set if a goal arrived (or shutdown was
+              # requested) while the execute callback was still running,
+              # so this returns immediately instead of losing the wakeup;
+              # the flags themselves are re-checked at the top of the loop
+              goal_event.wait();
+              goal_event.clear();
 
 
 